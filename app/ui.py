@@ -1,16 +1,22 @@
-import debugpy
 import os
+import sys
+
+# Streamlit re-executes this script on every rerun: attach the debugger only
+# once per process (debugpy is a dev dependency, so import it lazily)
+if os.getenv("DEBUG_ATTACH", "false").lower() == "true" and not getattr(
+    sys, "_debugpy_attached", False
+):
+    import debugpy
 
-if os.getenv("DEBUG_ATTACH", "false").lower() == "true":
     debugpy.listen(("localhost", 5678))
     print("🪲 Waiting for debugger to attach on port 5678...")
     debugpy.wait_for_client()
     print("✅ Debugger attached.")
+    sys._debugpy_attached = True  # type: ignore[attr-defined]
 
 import streamlit as st
 
 # Add project root to Python path
-import sys
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parents[1]
@@ -22,14 +28,25 @@ from core.agent import Agent  # noqa: E402
 st.set_page_config(page_title="AI Knowledge Assistant")
 st.title("🧠 AI Knowledge Assistant (ReAct Reasoning Agent)")
 
-if "agent" not in st.session_state:
-    st.session_state.agent = Agent()
+
+@st.cache_resource
+def get_agent() -> Agent:
+    """One Agent (HTTP session, caches, worker pool) shared by all sessions."""
+    return Agent()
+
+
+agent = get_agent()
+
+# Conversation history is per browser session; only the Agent is shared
+if "history" not in st.session_state:
+    st.session_state.history = []
 
 question = st.text_area("Ask me anything:", height=120)
 go = st.button("Run")
 
 if go and question.strip():
     area = st.container()
+    live = st.empty()
     with st.spinner("Thinking..."):
 
         def draw(step):
@@ -49,6 +66,15 @@ if go and question.strip():
                 if step.final_answer:
                     st.success(step.final_answer)
 
+        def draw_tokens(text):
+            live.code(text, language="json")
+
         # stream steps
-        for _ in st.session_state.agent.run_stream(question, on_step=draw):
+        for _ in agent.run_stream(
+            question,
+            on_step=draw,
+            on_token=draw_tokens,
+            history=st.session_state.history,
+        ):
             pass
+    live.empty()
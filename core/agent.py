@@ -1,13 +1,20 @@
 from __future__ import annotations
+import functools
+import io
 import json
-import re
+import string
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from typing import Any, Dict, List, Optional, Tuple, Callable, Iterator, Protocol, cast
 
-from core.llm import call_llm
+import requests
+
+from core.llm import call_llm_stream, default_session, warmup
 from core.memory import Memory
+from core.text import lexical_relevance, normalize, similarity
 from core.tools import TOOL_REGISTRY as _TOOLS  # import untyped registry
+from core.tools import build_tools
 
 
 # ----- Type protocol for tools so mypy knows .call exists -----
@@ -19,56 +26,133 @@ class Tool(Protocol):
 TOOL_REGISTRY: Dict[str, Tool] = cast(Dict[str, Tool], _TOOLS)
 
 MAX_STEPS = 6
+DUPLICATE_SIMILARITY = 0.9  # inputs this similar to an earlier one count as repeats
 
-DECISION_PROMPT = """You are a reasoning agent that solves problems using THINK → ACT → OBSERVE.
-
-Return STRICT JSON ONLY. Do not include text outside JSON.
+# First-step search is started on the raw question while the model decides;
+# it is used if the model's search input is at least this similar
+SPECULATIVE_TOOL = "search"
+SPECULATIVE_SIMILARITY = 0.8
 
-If you need external info or current facts, prefer using 'search' first.
-If you have raw long text, consider 'summarize' before the final answer.
+# Output caps: decision/reflect JSON is short, relevance JSON is shorter
+DECISION_MAX_TOKENS = 256
+CONFIDENCE_MAX_TOKENS = 80
+COMBINED_MAX_TOKENS = DECISION_MAX_TOKENS + CONFIDENCE_MAX_TOKENS
 
-Formats:
+# Observations covering at least this share of the question's content words
+# are scored locally. Low overlap proves nothing (search results are often
+# just titles and URLs), so anything below still goes to the LLM.
+LOCAL_RELEVANCE_MIN = 0.6
 
-1) To ACT:
-{
-  "thought": "<why the action is needed>",
-  "action": {
-    "tool": "<one of: {tool_names}>",
-    "input": "<input for the tool>"
-  }
-}
-
-2) To ANSWER:
-{
-  "thought": "<why this is the final answer>",
-  "final_answer": "<concise final answer>"
-}
+DECISION_PROMPT = """You are a ReAct agent (THINK → ACT → OBSERVE). Reply with ONE JSON object only.
+ACT: {{"thought": "<why>", "action": {{"tool": "<one of: {tool_names}>", "input": "<tool input>"}}}}
+ANSWER: {{"thought": "<why>", "final_answer": "<concise answer>"}}
+Prefer 'search' for external or current facts, 'summarize' for long raw text.
 
 User question: {user_question}
 Context: {context}
 """
 
-REFLECT_PROMPT = """You used "{tool}" with input "{tool_input}".
+REFLECT_PROMPT = """User question: {user_question}
+You used "{tool}" with input "{tool_input}".
 OBSERVATION:
 {observation}
 
-Now decide the next step. 
-If more info or compression is needed, ACT again.
-Otherwise provide final_answer.
-
-Return STRICT JSON ONLY, using the same schema.
-User question: {user_question}
+ACT again if more info or compression is needed, otherwise ANSWER. Reply with ONE JSON object only.
+ACT: {{"thought": "<why>", "action": {{"tool": "<one of: {tool_names}>", "input": "<tool input>"}}}}
+ANSWER: {{"thought": "<why>", "final_answer": "<concise answer>"}}
 """
 
-CONFIDENCE_PROMPT = """You are a verifier. Score how relevant the OBSERVATION is to the USER QUESTION.
-
-Return STRICT JSON, e.g.:
-{ "relevance": 0.0 to 1.0, "reason": "<why>" }
+CONFIDENCE_PROMPT = """Score how relevant the OBSERVATION is to the USER QUESTION.
+Reply with JSON only: {{"relevance": <0.0-1.0>, "reason": "<short why>"}}
 
 USER QUESTION: {user_question}
 OBSERVATION: {observation}
 """
 
+# Relevance score and next step in one reply (saves a round-trip per step)
+COMBINED_PROMPT = """User question: {user_question}
+You used "{tool}" with input "{tool_input}".
+OBSERVATION:
+{observation}
+
+Score how relevant the OBSERVATION is to the question, then ACT again if more info or compression is needed, otherwise ANSWER. Reply with ONE JSON object only.
+ACT: {{"relevance": <0.0-1.0>, "reason": "<short why>", "thought": "<why>", "action": {{"tool": "<one of: {tool_names}>", "input": "<tool input>"}}}}
+ANSWER: {{"relevance": <0.0-1.0>, "reason": "<short why>", "thought": "<why>", "final_answer": "<concise answer>"}}
+"""
+
+
+# ----- Prompt templates, parsed once at import -----
+class _Template:
+    """A str.format template split into literal/field parts up front."""
+
+    def __init__(self, template: str, **bound: str) -> None:
+        self._parts: List[Tuple[bool, str]] = []  # (is_field, literal or name)
+        literal = ""
+        for text, field, _, _ in string.Formatter().parse(template):
+            literal += text
+            if field is None:
+                continue
+            if field in bound:
+                literal += bound[field]
+            else:
+                self._parts += [(False, literal), (True, field)]
+                literal = ""
+        self._parts.append((False, literal))
+
+    def format(self, **fields: str) -> str:
+        return "".join(
+            str(fields[v]) if is_field else v for is_field, v in self._parts
+        )
+
+
+_TOOL_NAMES = ", ".join(TOOL_REGISTRY)
+_DECISION = _Template(DECISION_PROMPT, tool_names=_TOOL_NAMES)
+_REFLECT = _Template(REFLECT_PROMPT, tool_names=_TOOL_NAMES)
+_COMBINED = _Template(COMBINED_PROMPT, tool_names=_TOOL_NAMES)
+_CONFIDENCE = _Template(CONFIDENCE_PROMPT)
+
+
+# ----- JSON schemas for constrained decoding -----
+def _object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+_STR: Dict[str, Any] = {"type": "string"}
+_SCORE_PROPS: Dict[str, Any] = {
+    "relevance": {"type": "number", "minimum": 0, "maximum": 1},
+    "reason": _STR,
+}
+_ACT_PROPS: Dict[str, Any] = {
+    "thought": _STR,
+    "action": _object(
+        {"tool": {"type": "string", "enum": list(TOOL_REGISTRY)}, "input": _STR}
+    ),
+}
+_ANSWER_PROPS: Dict[str, Any] = {"thought": _STR, "final_answer": _STR}
+
+DECISION_SCHEMA = {"anyOf": [_object(_ACT_PROPS), _object(_ANSWER_PROPS)]}
+CONFIDENCE_SCHEMA = _object(_SCORE_PROPS)
+COMBINED_SCHEMA = {
+    "anyOf": [
+        _object({**_SCORE_PROPS, **_ACT_PROPS}),
+        _object({**_SCORE_PROPS, **_ANSWER_PROPS}),
+    ]
+}
+
+# Appended only when a reply could not be parsed, as a one-shot retry
+JSON_RETRY_HINT = """
+Your previous reply was not valid JSON. Examples of valid replies:
+{"thought": "I need current facts", "action": {"tool": "search", "input": "latest Python release"}}
+{"thought": "The observation answers the question", "final_answer": "Python 3.13"}
+"""
+
+_INVALID_JSON_THOUGHT = "(model did not return valid JSON)"
+
 
 @dataclass
 class Step:
@@ -82,52 +166,149 @@ class Step:
     final_answer: Optional[str] = None
 
 
+def _find_json_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} block in text, honoring JSON strings."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_str = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_json_cached(text: str) -> Dict[str, Any]:
+    # Constrained decoding makes this the normal path
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data
+    except Exception:
+        pass
+
+    # Servers that ignore response_format may still wrap the JSON in prose
+    block = _find_json_object(text)
+    if block is not None:
+        # Try as-is, then with single quotes fixed
+        for attempt in (block, block.replace("'", '"')):
+            try:
+                data = json.loads(attempt)
+                if isinstance(data, dict):
+                    return data
+            except Exception:
+                pass
+
+    # Fallback: fabricate a minimal JSON structure so we don't crash
+    return {
+        "thought": _INVALID_JSON_THOUGHT,
+        "final_answer": f"[Invalid JSON] {text.strip()[:400]}",
+    }
+
+
 class Agent:
-    def __init__(self) -> None:
+    def __init__(self, http: Optional[requests.Session] = None) -> None:
         self.memory = Memory()
+        # Injected sessions are owned (and closed) by the caller; otherwise
+        # share the process-wide one that core.llm closes at exit
+        self.http = http or default_session()
+        self.tools: Dict[str, Tool] = cast(Dict[str, Tool], build_tools(self.http))
+        # Worker threads for LLM/tool calls that can overlap within a step
+        self._pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="agent")
+        # Speculative searches get their own workers so LLM scoring calls
+        # from other sessions can't queue ahead of them
+        self._tool_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool")
+        # Connect to the LLM now rather than on the user's first question
+        self._pool.submit(warmup, self.http)
 
     # ---------- public streaming ----------
     def run_stream(
         self,
         prompt: str,
         on_step: Optional[Callable[[Step], None]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        history: Optional[List[Dict[str, str]]] = None,
     ) -> Iterator[Step]:
-        steps, final_answer = self._reason(prompt, on_step=on_step)
-        self.memory.save(prompt, final_answer)
-        self.memory.append_trace(prompt, [asdict(s) for s in steps], final_answer)
+        """
+        `history` is a caller-owned list of prior turns (e.g. one per UI
+        session) that is used as context and extended with this turn; when
+        omitted, the shared Memory file is used instead.
+        """
+        turns = self.memory.load() if history is None else list(history)
+        steps, final_answer = self._reason(
+            prompt, turns, on_step=on_step, on_token=on_token
+        )
+        self._remember(prompt, steps, final_answer, history)
         for s in steps:
             yield s
 
     # ---------- non-stream ----------
-    def run(self, prompt: str) -> str:
-        steps, final_answer = self._reason(prompt, on_step=None)
-        self.memory.save(prompt, final_answer)
-        self.memory.append_trace(prompt, [asdict(s) for s in steps], final_answer)
+    def run(self, prompt: str, history: Optional[List[Dict[str, str]]] = None) -> str:
+        turns = self.memory.load() if history is None else list(history)
+        steps, final_answer = self._reason(prompt, turns, on_step=None)
+        self._remember(prompt, steps, final_answer, history)
         return self._render(steps, final_answer)
 
+    def _remember(
+        self,
+        prompt: str,
+        steps: List[Step],
+        final_answer: str,
+        history: Optional[List[Dict[str, str]]],
+    ) -> None:
+        if history is None:
+            self.memory.save(prompt, final_answer)
+        else:
+            history.append({"user": prompt, "agent": final_answer})
+            del history[: -self.memory.keep]
+        # Traces are an append-only log of every run, shared by all callers
+        self.memory.append_trace(prompt, [asdict(s) for s in steps], final_answer)
+
     # ---------- core reasoning ----------
     def _reason(
         self,
         prompt: str,
+        history: List[Dict[str, str]],
         on_step: Optional[Callable[[Step], None]],
+        on_token: Optional[Callable[[str], None]] = None,
     ) -> tuple[List[Step], str]:
-        history = self.memory.load()
         context = self._format_context(history)
-        tool_names = ", ".join(TOOL_REGISTRY.keys())
 
         steps: List[Step] = []
-        seen: set[Tuple[str, str]] = set()
+        seen: Dict[str, List[str]] = {}  # tool -> normalized inputs already run
 
-        # Initial decision
-        decision_raw = call_llm(
-            DECISION_PROMPT.format(
-                tool_names=tool_names,
+        # Initial decision, with the likely first search already in flight
+        speculative: Optional[Future[str]] = None
+        if SPECULATIVE_TOOL in self.tools:
+            speculative = self._tool_pool.submit(
+                self.tools[SPECULATIVE_TOOL].call, prompt
+            )
+        decision = self._decide(
+            _DECISION.format(
                 user_question=prompt,
                 context=context,
             ),
             history,
+            on_token,
         )
-        decision = self._parse_json_safe(decision_raw)
+        prefetched = self._claim_speculative(speculative, decision, prompt)
         steps.append(Step(idx=1, thought=decision.get("thought", "(no thought)")))
         if on_step:
             on_step(steps[-1])
@@ -145,47 +326,44 @@ class Agent:
             tool_input = str(action.get("input", "")).strip()
 
             # Tool validation
-            if not tool_name or tool_name not in TOOL_REGISTRY:
+            if not tool_name or tool_name not in self.tools:
                 msg = f"⚠️ Unknown or missing tool '{tool_name}'."
                 steps[-1].observation = msg
                 steps[-1].final_answer = msg
                 return steps, msg
 
-            if (tool_name, tool_input) in seen:
+            norm_input = normalize(tool_input)
+            prior = seen.setdefault(tool_name, [])
+            if any(
+                p == norm_input or similarity(p, norm_input) >= DUPLICATE_SIMILARITY
+                for p in prior
+            ):
                 msg = f"⚠️ Repeated action {tool_name}({tool_input}) — stopping."
                 steps[-1].observation = msg
                 steps[-1].final_answer = msg
                 return steps, msg
-            seen.add((tool_name, tool_input))
+            prior.append(norm_input)
 
-            # Execute tool
-            try:
-                obs = str(TOOL_REGISTRY[tool_name].call(tool_input)) or "(no data)"
-            except Exception as e:
-                obs = f"[Tool Error] {type(e).__name__}: {e}\n{traceback.format_exc(limit=1)}"
+            # Execute tool; a claimed prefetch ran on the raw question, so
+            # record that as the input actually searched
+            if prefetched is not None:
+                tool_input = prompt
+                prior.append(normalize(prompt))
+            obs = self._call_tool(tool_name, tool_input, prefetched)
+            prefetched = None
 
             steps[-1].tool = tool_name
             steps[-1].tool_input = tool_input
             steps[-1].observation = obs
 
-            # Confidence scoring
-            score = self._score_observation(prompt, obs)
+            decision, score = self._reflect(
+                prompt, tool_name, tool_input, obs, history, on_token
+            )
             steps[-1].confidence = cast(Optional[float], score.get("relevance"))
             steps[-1].confidence_reason = cast(Optional[str], score.get("reason"))
             if on_step:
                 on_step(steps[-1])
 
-            # Reflect → next reasoning step
-            reflect_raw = call_llm(
-                REFLECT_PROMPT.format(
-                    tool=tool_name,
-                    tool_input=tool_input,
-                    observation=obs,
-                    user_question=prompt,
-                ),
-                history,
-            )
-            decision = self._parse_json_safe(reflect_raw)
             steps.append(
                 Step(idx=i + 1, thought=decision.get("thought", "(no thought)"))
             )
@@ -197,48 +375,180 @@ class Agent:
         return steps, str(steps[-1].final_answer or "")
 
     # ---------- helpers ----------
+    def _call_tool(
+        self,
+        tool_name: str,
+        tool_input: str,
+        prefetched: Optional[Future[str]] = None,
+    ) -> str:
+        """Run a tool inline, or collect the result of a prefetched run."""
+        try:
+            if prefetched is not None:
+                return str(prefetched.result()) or "(no data)"
+            return str(self.tools[tool_name].call(tool_input)) or "(no data)"
+        except Exception as e:
+            return f"[Tool Error] {type(e).__name__}: {e}\n{traceback.format_exc(limit=1)}"
+
+    @staticmethod
+    def _claim_speculative(
+        speculative: Optional[Future[str]], decision: Dict[str, Any], question: str
+    ) -> Optional[Future[str]]:
+        """
+        Keep the speculative search if the first decision is a matching search;
+        otherwise cancel it (a search already running still warms the cache).
+        """
+        if speculative is None:
+            return None
+        action = decision.get("action")
+        if (
+            isinstance(action, dict)
+            and action.get("tool") == SPECULATIVE_TOOL
+            and similarity(str(action.get("input", "")), question)
+            >= SPECULATIVE_SIMILARITY
+        ):
+            return speculative
+        speculative.cancel()
+        return None
+
+    def _stream_json(
+        self,
+        prompt: str,
+        history: Optional[List[Dict[str, str]]],
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: int = DECISION_MAX_TOKENS,
+        json_schema: Dict[str, Any] = DECISION_SCHEMA,
+    ) -> str:
+        """
+        Stream an LLM reply, reporting the partial text to on_token, and stop
+        decoding as soon as a complete JSON object has been emitted.
+        """
+        buf = ""
+        stream = call_llm_stream(
+            prompt,
+            history,
+            max_tokens=max_tokens,
+            json_schema=json_schema,
+            session=self.http,
+            until=_find_json_object,
+        )
+        try:
+            for chunk in stream:
+                buf += chunk
+                if on_token:
+                    on_token(buf)
+        finally:
+            stream.close()
+        obj = _find_json_object(buf)
+        return obj if obj is not None else buf.strip()
+
+    def _reflect(
+        self,
+        question: str,
+        tool_name: str,
+        tool_input: str,
+        obs: str,
+        history: Optional[List[Dict[str, str]]],
+        on_token: Optional[Callable[[str], None]],
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Return (next decision, relevance score) for a tool observation."""
+        fields = dict(
+            tool=tool_name,
+            tool_input=tool_input,
+            observation=self._compact(obs),
+            user_question=question,
+        )
+
+        # Clearly relevant observations need no LLM score: only reflect
+        local = lexical_relevance(question, obs)
+        if local is not None and local >= LOCAL_RELEVANCE_MIN:
+            decision = self._decide(_REFLECT.format(**fields), history, on_token)
+            score = {"relevance": round(local, 2), "reason": "heuristic: term overlap"}
+            return decision, score
+
+        # Score + reflect in a single round-trip
+        combined = self._parse_json_safe(
+            self._stream_json(
+                _COMBINED.format(**fields),
+                history,
+                on_token,
+                max_tokens=COMBINED_MAX_TOKENS,
+                json_schema=COMBINED_SCHEMA,
+            )
+        )
+        parsed_ok = combined.get("thought") != _INVALID_JSON_THOUGHT
+
+        # Fallbacks for whatever part the combined reply missed. The targeted
+        # score runs in the background while reflect streams: the score does
+        # not feed into the reflect prompt.
+        score_future = None
+        if not (parsed_ok and "relevance" in combined):
+            score_future = self._pool.submit(self._score_observation, question, obs)
+
+        if parsed_ok and ("action" in combined or "final_answer" in combined):
+            decision = combined
+        else:
+            decision = self._decide(_REFLECT.format(**fields), history, on_token)
+
+        score = (
+            score_future.result()
+            if score_future is not None
+            else self._normalize_score(combined)
+        )
+        return decision, score
+
+    def _decide(
+        self,
+        prompt: str,
+        history: Optional[List[Dict[str, str]]],
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, Any]:
+        """Get the next thought/action; retry once with examples on bad JSON."""
+        raw = self._stream_json(prompt, history, on_token)
+        decision = self._parse_json_safe(raw)
+        if decision.get("thought") == _INVALID_JSON_THOUGHT and not raw.startswith(
+            "[LLM error]"
+        ):
+            decision = self._parse_json_safe(
+                self._stream_json(prompt + JSON_RETRY_HINT, history, on_token)
+            )
+        return decision
+
     def _score_observation(self, question: str, observation: str) -> Dict[str, Any]:
         """Ask the LLM to score how relevant a tool result is."""
-        raw = call_llm(
-            CONFIDENCE_PROMPT.format(user_question=question, observation=observation),
+        raw = self._stream_json(
+            _CONFIDENCE.format(
+                user_question=question, observation=self._compact(observation, 800, 200)
+            ),
             history=None,
+            max_tokens=CONFIDENCE_MAX_TOKENS,
+            json_schema=CONFIDENCE_SCHEMA,
         )
-        parsed = self._parse_json_safe(raw)
+        return self._normalize_score(self._parse_json_safe(raw))
+
+    @staticmethod
+    def _normalize_score(parsed: Dict[str, Any]) -> Dict[str, Any]:
+        """Clamp relevance into [0, 1], or None if it isn't a number."""
         try:
             r = float(parsed.get("relevance", 0.0))
-            parsed["relevance"] = max(0.0, min(1.0, r))
+            relevance: Optional[float] = max(0.0, min(1.0, r))
         except Exception:
-            parsed["relevance"] = None
-        return parsed
+            relevance = None
+        return {"relevance": relevance, "reason": parsed.get("reason")}
+
+    @staticmethod
+    def _compact(text: str, head: int = 1500, tail: int = 500) -> str:
+        """Keep the start and end of a long observation for prompting."""
+        if len(text) <= head + tail:
+            return text
+        return f"{text[:head]}\n...[truncated]...\n{text[-tail:]}"
 
     @staticmethod
     def _parse_json_safe(text: Any) -> Dict[str, Any]:
         """Try to extract and sanitize JSON even from messy LLM text."""
         if not isinstance(text, str):
             text = str(text)
-
-        # Attempt direct JSON parse
-        try:
-            return cast(Dict[str, Any], json.loads(text))
-        except Exception:
-            pass
-
-        # Try to extract first JSON-like block
-        m = re.search(r"\{.*\}", text, re.DOTALL)
-        if m:
-            raw_json = m.group(0)
-            # Try to fix single quotes or minor issues
-            fixed = raw_json.replace("'", '"')
-            try:
-                return cast(Dict[str, Any], json.loads(fixed))
-            except Exception:
-                pass
-
-        # Fallback: fabricate a minimal JSON structure so we don't crash
-        return {
-            "thought": "(model did not return valid JSON)",
-            "final_answer": f"[Invalid JSON] {text.strip()[:400]}",
-        }
+        # Copy so callers can't mutate the memoized result
+        return dict(_parse_json_cached(text))
 
     @staticmethod
     def _format_context(history: List[Dict[str, str]]) -> str:
@@ -250,19 +560,19 @@ class Agent:
 
     @staticmethod
     def _render(steps: List[Step], final_answer: str) -> str:
-        lines: List[str] = []
+        buf = io.StringIO()
+        write = buf.write
         for s in steps:
-            lines.append(f"### Step {s.idx}")
-            lines.append(f"Thought: {s.thought}")
+            write(f"### Step {s.idx}\nThought: {s.thought}\n")
             if s.tool:
-                lines.append(f"Action: {s.tool}('{s.tool_input}')")
+                write(f"Action: {s.tool}('{s.tool_input}')\n")
             if s.observation:
-                lines.append(f"Observation: {s.observation}")
+                write(f"Observation: {s.observation}\n")
             if s.confidence is not None:
                 reason = s.confidence_reason or ""
-                lines.append(f"Relevance: {s.confidence:.2f} — {reason}")
+                write(f"Relevance: {s.confidence:.2f} — {reason}\n")
             if s.final_answer:
-                lines.append(f"✅ Final Answer: {s.final_answer}")
-            lines.append("")
-        lines.append(f"✅ Final Answer: {final_answer}")
-        return "\n".join(lines)
+                write(f"✅ Final Answer: {s.final_answer}\n")
+            write("\n")
+        write(f"✅ Final Answer: {final_answer}")
+        return buf.getvalue()
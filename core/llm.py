@@ -1,8 +1,14 @@
 from __future__ import annotations
+import atexit
+import hashlib
+import json
 import requests
-from typing import List, Dict
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 
+from core.cache import LRUCache
+
 load_dotenv()
 
 LMSTUDIO_BASE_URL = "http://localhost:1234/v1"
@@ -10,13 +16,53 @@ LMSTUDIO_API_KEY = "lmstudio"
 MODEL = "tinyllama-1.1b-chat-v1.0"
 
 
-def call_llm(prompt: str, history: List[Dict[str, str]] | None = None) -> str:
-    """Call LM Studio or other local OpenAI-compatible endpoint."""
+def new_session() -> requests.Session:
+    """Keep-alive session so repeated calls reuse the same TCP connection."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# The process-wide session, used whenever a caller doesn't inject one
+_SESSION = new_session()
+atexit.register(_SESSION.close)
+
+
+def default_session() -> requests.Session:
+    return _SESSION
+
+# Exact-match response cache, keyed by a hash of the full request payload
+_CACHE: LRUCache[str] = LRUCache(maxsize=1024)
+
+
+def _cache_key(payload: Dict[str, Any]) -> str:
+    return hashlib.sha1(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def _cacheable(
+    text: str, finish_reason: Any, json_schema: Dict[str, Any] | None
+) -> bool:
+    """Only replay replies that are complete: non-empty, not cut off, valid JSON."""
+    if not text or finish_reason == "length":
+        return False
+    if json_schema is not None:
+        try:
+            json.loads(text)
+        except ValueError:
+            return False
+    return True
 
-    LMSTUDIO_BASE_URL = "http://localhost:1234/v1"
-    LMSTUDIO_API_KEY = "lmstudio"
-    MODEL = "tinyllama-1.1b-chat-v1.0"
 
+def _build_request(
+    prompt: str,
+    history: List[Dict[str, str]] | None,
+    max_tokens: int,
+    json_schema: Dict[str, Any] | None = None,
+) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
     url = LMSTUDIO_BASE_URL.rstrip("/") + "/completions"
     headers = {
         "Content-Type": "application/json",
@@ -32,21 +78,130 @@ def call_llm(prompt: str, history: List[Dict[str, str]] | None = None) -> str:
 
     prompt_text = flatten_messages(messages)
 
-    payload = {
+    payload: Dict[str, Any] = {
         "model": MODEL,
         "prompt": prompt_text,
         "temperature": 0.6,
-        "max_tokens": 800,
+        "max_tokens": max_tokens,
+        # A run of blank lines means the model has drifted past its answer
+        "stop": ["\n\n\n"],
     }
+    if json_schema is not None:
+        # Grammar-constrained decoding: the server can only emit matching JSON
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "reply", "strict": True, "schema": json_schema},
+        }
+    return url, headers, payload
+
+
+def call_llm(
+    prompt: str,
+    history: List[Dict[str, str]] | None = None,
+    max_tokens: int = 200,
+    cache_skip: bool = False,
+    json_schema: Dict[str, Any] | None = None,
+    session: requests.Session | None = None,
+) -> str:
+    """
+    Call LM Studio or other local OpenAI-compatible endpoint.
+    Identical requests are answered from an in-memory cache unless cache_skip.
+    With json_schema, the reply is constrained to JSON matching that schema.
+    """
+    url, headers, payload = _build_request(prompt, history, max_tokens, json_schema)
+    key = _cache_key(payload)
+    if not cache_skip:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            return cached
 
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=120)
+        resp = (session or _SESSION).post(
+            url, headers=headers, json=payload, timeout=120
+        )
         resp.raise_for_status()
-        data = resp.json()
-        text: str = str(data["choices"][0].get("text", "")).strip()
-        return text
+        choice = resp.json()["choices"][0]
+        text: str = str(choice.get("text", "")).strip()
     except Exception as e:
         return f"[LLM error] {type(e).__name__}: {e}"
+    if _cacheable(text, choice.get("finish_reason"), json_schema):
+        _CACHE.put(key, text)
+    return text
+
+
+def call_llm_stream(
+    prompt: str,
+    history: List[Dict[str, str]] | None = None,
+    max_tokens: int = 200,
+    cache_skip: bool = False,
+    json_schema: Dict[str, Any] | None = None,
+    session: requests.Session | None = None,
+    until: Callable[[str], Optional[str]] | None = None,
+) -> Iterator[str]:
+    """
+    Same as call_llm, but yields text chunks as the server produces them (SSE).
+    If `until` maps the text so far to a result, the stream ends there: the
+    HTTP response is closed (the server stops decoding) and that result is
+    cached. Otherwise a reply is cached only if it ended normally and is
+    complete (see _cacheable); closing the generator early caches nothing.
+    """
+    url, headers, payload = _build_request(prompt, history, max_tokens, json_schema)
+    key = _cache_key(payload)
+    if not cache_skip:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    payload["stream"] = True
+    text = ""
+    finish_reason = None
+    try:
+        with (session or _SESSION).post(
+            url, headers=headers, json=payload, timeout=120, stream=True
+        ) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                choice = json.loads(data)["choices"][0]
+                finish_reason = choice.get("finish_reason") or finish_reason
+                # /completions streams "text"; chat-style servers stream "delta"
+                chunk = choice.get("text") or (choice.get("delta") or {}).get(
+                    "content"
+                )
+                if not chunk:
+                    continue
+                text += str(chunk)
+                done = until(text) if until else None
+                if done is not None:
+                    if _cacheable(done, None, json_schema):
+                        _CACHE.put(key, done)
+                    yield str(chunk)
+                    return
+                yield str(chunk)
+    except Exception as e:
+        yield f"[LLM error] {type(e).__name__}: {e}"
+        return
+    # With `until`, reaching the end unmatched means the reply is incomplete
+    if until is None and _cacheable(text, finish_reason, json_schema):
+        _CACHE.put(key, text)
+
+
+def warmup(session: requests.Session | None = None) -> bool:
+    """Open a keep-alive connection to the endpoint ahead of the first call."""
+    try:
+        resp = (session or _SESSION).get(
+            LMSTUDIO_BASE_URL.rstrip("/") + "/models",
+            headers={"Authorization": f"Bearer {LMSTUDIO_API_KEY}"},
+            timeout=5,
+        )
+        return resp.ok
+    except Exception:
+        return False
 
 
 def flatten_messages(messages: list[dict[str, str]]) -> str:
@@ -58,8 +213,5 @@ def flatten_messages(messages: list[dict[str, str]]) -> str:
         if role and content:
             lines.append(f"{role}: {content}")
     # Encourage the model to output valid JSON
-    lines.append(
-        "\nAssistant: Please respond with ONLY a valid JSON object. "
-        'Example: {"thought": "<reasoning>", "final_answer": "<answer>"}'
-    )
+    lines.append("\nAssistant: Please respond with ONLY a valid JSON object.")
     return "\n".join(lines)
@@ -1,19 +1,27 @@
 import json
 import logging
-from datetime import datetime
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RESERVED = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message",
+    "asctime",
+}
 
 
 class JsonFormatter(logging.Formatter):
     def format(self, record):
         log_obj = {
-            "time": datetime.now(),
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
             "level": record.levelname,
             "event": record.name,
             "message": record.getMessage(),
         }
-        if record.args:
-            log_obj.update(record.args)
-        return json.dumps(log_obj)
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                log_obj[key] = value
+        if record.exc_info:
+            log_obj["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(log_obj, ensure_ascii=False, default=str)
 
 
 logger = logging.getLogger("agent")
@@ -1,34 +1,106 @@
 from __future__ import annotations
 import json
+import os
+import threading
+from collections import deque
 from pathlib import Path
-from typing import List, Dict, Any, cast
+from typing import List, Dict, Any, Optional, Tuple, cast
+
+# Rewrite the memory file once it holds this many times `keep` turns
+COMPACT_FACTOR = 10
 
 
 class Memory:
-    def __init__(self, path: str = "data_memory.json", keep: int = 8) -> None:
+    """
+    Append-only JSONL store: one turn per line in `path`, one full reasoning
+    trace per line in `<path stem>.traces.jsonl`.
+    """
+
+    def __init__(self, path: str = "data_memory.jsonl", keep: int = 8) -> None:
         self.path = Path(path)
         self.keep = keep
-        if not self.path.exists():
-            self.path.write_text("[]", encoding="utf-8")
+        self.traces_path = self.path.with_suffix(".traces.jsonl")
+        self._lock = threading.Lock()
+        self.path.touch(exist_ok=True)
+        # Appending after a torn line would glue the new record onto it
+        self._drop_torn_tail(self.path)
+        self._drop_torn_tail(self.traces_path)
+        with self.path.open(encoding="utf-8") as f:
+            self._lines = sum(1 for _ in f)
+        # (mtime_ns, size) of the file when _cached was read
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._cached: List[Dict[str, str]] = []
 
     def load(self) -> List[Dict[str, str]]:
-        data: Any = json.loads(self.path.read_text(encoding="utf-8"))
-        return cast(List[Dict[str, str]], data)
+        """Last `keep` turns; re-read only when the file has changed."""
+        with self._lock:
+            st = self.path.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+            if stamp != self._stamp:
+                with self.path.open(encoding="utf-8") as f:
+                    tail = deque(f, maxlen=self.keep)
+                self._cached = cast(List[Dict[str, str]], self._parse_lines(tail))
+                self._stamp = stamp
+            return list(self._cached)
 
     def save(self, user: str, agent: str) -> None:
-        data = self.load()
-        data.append({"user": user, "agent": agent})
-        self.path.write_text(json.dumps(data[-self.keep :], indent=2), encoding="utf-8")
+        line = json.dumps({"user": user, "agent": agent}, ensure_ascii=False)
+        with self._lock:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._lines += 1
+            if self._lines > COMPACT_FACTOR * self.keep:
+                self._compact()
 
     def append_trace(
         self, user: str, steps: List[Dict[str, Any]], final_answer: str
     ) -> None:
-        tp = self.path.with_suffix(".traces.json")
-        if not tp.exists():
-            tp.write_text("[]", encoding="utf-8")
-        traces: Any = json.loads(tp.read_text(encoding="utf-8"))
-        traces = cast(List[Dict[str, Any]], traces)
-        traces.append({"user": user, "steps": steps, "final": final_answer})
-        tp.write_text(
-            json.dumps(traces, ensure_ascii=False, indent=2), encoding="utf-8"
+        line = json.dumps(
+            {"user": user, "steps": steps, "final": final_answer}, ensure_ascii=False
         )
+        with self._lock:
+            with self.traces_path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def _compact(self) -> None:
+        """Keep only the last `keep` turns, swapping the file in atomically."""
+        with self.path.open(encoding="utf-8") as f:
+            tail = deque((line for line in f if line.endswith("\n")), maxlen=self.keep)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text("".join(tail), encoding="utf-8")
+        os.replace(tmp, self.path)
+        self._lines = len(tail)
+
+    @staticmethod
+    def _drop_torn_tail(path: Path) -> None:
+        """Truncate a last line that an interrupted write left without "\n"."""
+        if not path.exists():
+            return
+        with path.open("rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                size = min(4096, pos)
+                f.seek(pos - size)
+                block = f.read(size)
+                if pos == end and block.endswith(b"\n"):
+                    return
+                idx = block.rfind(b"\n")
+                if idx >= 0:
+                    f.truncate(pos - size + idx + 1)
+                    return
+                pos -= size
+            f.truncate(0)
+
+    @staticmethod
+    def _parse_lines(lines: Any) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                out.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A corrupt line — skip it rather than fail the whole load
+                continue
+        return out
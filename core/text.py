@@ -0,0 +1,56 @@
+from __future__ import annotations
+import functools
+import re
+from typing import FrozenSet, Optional
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be but by can could did do does for from had has have how
+    i if in into is it its me my of on or our so than that the their them then
+    there these they this to us was we were what when where which who whom why
+    will with would you your about please tell give show find
+    """.split()
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def content_terms(text: str) -> FrozenSet[str]:
+    """Lower-cased content words with stopwords and trivial plurals removed."""
+    terms = set()
+    for tok in _TOKEN_RE.findall(text.lower()):
+        if tok in STOPWORDS or len(tok) < 2:
+            continue
+        if len(tok) > 3 and tok.endswith("s") and not tok.endswith("ss"):
+            tok = tok[:-1]
+        terms.add(tok)
+    return frozenset(terms)
+
+
+def lexical_relevance(question: str, observation: str) -> Optional[float]:
+    """
+    Fraction of the question's content words that appear in the observation,
+    in [0, 1]. None when the question has no content words to compare.
+    """
+    q = content_terms(question)
+    if not q:
+        return None
+    o = content_terms(observation[:2000])
+    return len(q & o) / len(q)
+
+
+def normalize(text: str) -> str:
+    """Lower-case and collapse whitespace."""
+    return " ".join(text.lower().split())
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    Order-insensitive similarity in [0, 1] (Dice over content words), so
+    "weather in NYC" and "NYC weather" score 1.0.
+    """
+    ta, tb = content_terms(a), content_terms(b)
+    if not ta or not tb:
+        return 1.0 if normalize(a) == normalize(b) else 0.0
+    return 2 * len(ta & tb) / (len(ta) + len(tb))
@@ -1,9 +1,12 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Callable, List
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Union
+
+import requests
 from duckduckgo_search import DDGS
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from core.cache import LRUCache
 from core.llm import call_llm
 
 
@@ -22,6 +25,19 @@ def _ddg_text(query: str, max_results: int = 5) -> List[dict]:
         return list(ddgs.text(query, max_results=max_results))
 
 
+# Search results keyed by normalized query, reused for 10 minutes
+_SEARCH_CACHE: LRUCache[List[dict]] = LRUCache(maxsize=256, ttl=600)
+
+
+def _cached_ddg_text(query: str, max_results: int = 5) -> List[dict]:
+    key = (" ".join(query.lower().split()), max_results)
+    results = _SEARCH_CACHE.get(key)
+    if results is None:
+        results = _ddg_text(query, max_results=max_results)
+        _SEARCH_CACHE.put(key, results)
+    return results
+
+
 def search(query: str) -> str:
     """
     DuckDuckGo text search (top results summarized).
@@ -32,7 +48,7 @@ def search(query: str) -> str:
     if not q:
         return "No query provided"
     try:
-        results = _ddg_text(q, max_results=5)
+        results = _cached_ddg_text(q, max_results=5)
         if not results:
             return "No results found"
         lines = []
@@ -53,6 +69,7 @@ def echo(text: str) -> str:
 class SummarizeTool:
     name: str = "summarize"
     description: str = "Summarize a given text into 3-5 bullet points."
+    session: Optional[requests.Session] = field(default=None, repr=False)
 
     def call(self, text: str) -> str:
         prompt = (
@@ -60,13 +77,20 @@ class SummarizeTool:
             f"TEXT:\n{text}\n\n"
             "Return plain text bullets, no JSON."
         )
-        return call_llm(prompt, history=None)
+        return call_llm(prompt, history=None, max_tokens=300, session=self.session)
+
+
+def build_tools(
+    session: Optional[requests.Session] = None,
+) -> Dict[str, Union[Tool, SummarizeTool]]:
+    """Tool registry; LLM-backed tools make their calls through `session`."""
+    return {
+        "search": Tool(
+            name="search", description="Search the web for information", call=search
+        ),
+        "echo": Tool(name="echo", description="Echo back the input text", call=echo),
+        "summarize": SummarizeTool(session=session),
+    }
 
 
-TOOL_REGISTRY = {
-    "search": Tool(
-        name="search", description="Search the web for information", call=search
-    ),
-    "echo": Tool(name="echo", description="Echo back the input text", call=echo),
-    "summarize": SummarizeTool(),
-}
+TOOL_REGISTRY = build_tools()
@@ -0,0 +1,47 @@
+import json
+
+from core.memory import COMPACT_FACTOR, Memory
+
+
+def test_save_after_torn_line_keeps_new_turn(tmp_path):
+    path = tmp_path / "mem.jsonl"
+    path.write_text(
+        json.dumps({"user": "before", "agent": "ok"}) + "\n" + '{"user": "to',
+        encoding="utf-8",
+    )
+
+    mem = Memory(str(path), keep=8)
+    mem.save("after", "torn")
+
+    assert mem.load() == [
+        {"user": "before", "agent": "ok"},
+        {"user": "after", "agent": "torn"},
+    ]
+    assert path.read_text(encoding="utf-8").endswith("\n")
+
+
+def test_torn_trace_line_is_dropped(tmp_path):
+    path = tmp_path / "mem.jsonl"
+    traces = tmp_path / "mem.traces.jsonl"
+    traces.write_text('{"user": "half', encoding="utf-8")
+
+    Memory(str(path)).append_trace("q", [], "a")
+
+    lines = traces.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["user"] for line in lines] == ["q"]
+
+
+def test_compaction_keeps_last_turns(tmp_path):
+    path = tmp_path / "mem.jsonl"
+    mem = Memory(str(path), keep=2)
+
+    for i in range(COMPACT_FACTOR * 2 + 1):
+        mem.save(f"u{i}", "a")
+
+    # The write that crossed the threshold rewrote the file down to `keep`
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 2
+    assert [t["user"] for t in mem.load()] == ["u19", "u20"]
+
+    mem.save("u21", "a")
+    assert [t["user"] for t in mem.load()] == ["u20", "u21"]
+    assert [t["user"] for t in Memory(str(path), keep=2).load()] == ["u20", "u21"]